@@ -5,7 +5,7 @@ import numpy as np
 from PIL import Image, ImageTk
 import threading
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Import the new modules
 from camera_handler import CameraHandler
@@ -14,25 +14,36 @@ from image_processor import ImageProcessor
 class VisionTestApp(ctk.CTk):
     def __init__(self):
         super().__init__()
+        # Make sure OpenCV uses its optimized code paths and a thread pool spanning the cores
+        # (leaving one for the GUI and camera threads)
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(max(1, (os.cpu_count() or 2) - 1))
+
         self.title("uEye XS Vision Tester")
         self.geometry("1000x750")
         ctk.set_appearance_mode("dark")
 
         # Initialize modules
         self.image_processor = ImageProcessor()
-        # CameraHandler will be initialized with callbacks for status updates and frame delivery
+        # CameraHandler will be initialized with callbacks for status updates; frames are polled by _pump_frame
         self.camera_handler = CameraHandler(
             on_status_update=self.update_status,
-            on_frame_ready=self.process_and_display_frame,
             on_init_progress=self.update_init_progress,
             on_init_complete=self.on_camera_init_complete
         )
 
         self.last_frame = None # Stores the last captured frame for ROI selection and calibration
+        self._frame_cv = threading.Condition() # Notified whenever last_frame is replaced
+        self._frame_seq = 0 # Incremented with every new last_frame, lets calibration detect distinct frames
         self.roi = None # Not directly used, roi_start/end define the ROI
         self.ref_folder = "./reference/" # Folder to store reference images
         self.num_ref_images = 10 # Number of reference images to capture for calibration
         self.testing = False # Flag to indicate if the test is currently running
+        self._test_executor = ThreadPoolExecutor(max_workers=1) # Runs test cycles off the camera thread
+        self._pending_test = None # Future of the test cycle currently in flight, if any
+        # Compile the diff kernel in the background so the first test is not delayed; it runs on the
+        # test worker so it can never overlap a test cycle (concurrent parallel Numba launches abort)
+        self._test_executor.submit(self.image_processor.warm_up)
         self.result_text = ctk.StringVar(value="Status: Initializing camera...") # Status message for the top label
         os.makedirs(self.ref_folder, exist_ok=True) # Ensure reference folder exists
 
@@ -50,6 +61,19 @@ class VisionTestApp(ctk.CTk):
         # Video Label - where the camera feed will be displayed
         self.video_label = ctk.CTkLabel(self, text="")
         self.video_label.pack(padx=10, pady=(0, 10))
+        # Frames wider than max_display_width are shown downscaled by an integer factor;
+        # ROI selection and testing always work on the full resolution frame
+        self.max_display_width = 640
+        self.display_scale = max(1, -(-self.camera_handler.width // self.max_display_width))
+        display_w = self.camera_handler.width // self.display_scale
+        display_h = self.camera_handler.height // self.display_scale
+        # Single Tk image sized to the displayed frame; frames are pasted into it instead of
+        # allocating a new PhotoImage and reconfiguring the label on every frame
+        self._tk_img = ImageTk.PhotoImage(image=Image.new("RGB", (display_w, display_h)))
+        # Reusable buffers for the display path, avoid allocating new frame-sized arrays per frame
+        self._rgb_buf = np.empty((display_h, display_w, 3), dtype=np.uint8)
+        self._small_buf = np.empty((display_h, display_w, 3), dtype=np.uint8) if self.display_scale > 1 else None
+        self.video_label.configure(image=self._tk_img)
         # Bind mouse events for ROI selection
         self.video_label.bind("<Button-1>", self.mark_roi_start)
         self.video_label.bind("<B1-Motion>", self.mark_roi_drag)
@@ -87,11 +111,14 @@ class VisionTestApp(ctk.CTk):
         self.running = True # Flag to control the main application loop and camera thread
         self.roi_start = None # (x,y) coordinate for the start of ROI selection
         self.roi_end = None # (x,y) coordinate for the end of ROI selection
+        self._roi_box = None # Cached (x, y, w, h) of the ROI, refreshed whenever roi_start/roi_end change
         self.roi_enabled = False # Flag to indicate if ROI selection is active/complete
 
         # Start the camera capture in a separate thread to keep the GUI responsive
         self.capture_thread = threading.Thread(target=self.camera_handler.start_capture_loop, daemon=True)
         self.capture_thread.start()
+        # Poll the camera for the latest frame on the GUI thread
+        self.after(33, self._pump_frame)
 
     def update_status(self, text, color="white"):
         """Updates the main status label text and color."""
@@ -105,9 +132,8 @@ class VisionTestApp(ctk.CTk):
 
     def update_init_progress(self, value):
         """Updates the initialization progress bar."""
-        # Use .after() to ensure GUI updates happen on the main thread
-        self.after(0, lambda: self.init_progress.set(value))
-        self.after(0, self.update) # Force GUI update on main thread
+        # Use .after_idle() so the update runs on the main thread and coalesces with the next redraw
+        self.after_idle(self.init_progress.set, value)
 
     def on_camera_init_complete(self):
         """Callback executed when camera initialization is finished."""
@@ -121,11 +147,13 @@ class VisionTestApp(ctk.CTk):
         self.roi_enabled = False # Allow new ROI selection
         self.roi_start = None
         self.roi_end = None
+        self._update_roi_box()
 
     def reset_app(self):
         """Resets the application state, clearing ROI and test results."""
         self.roi_start = None
         self.roi_end = None
+        self._update_roi_box()
         self.roi_enabled = False
         self.testing = False
         self.progress.pack_forget() # Hide calibration progress bar
@@ -135,28 +163,39 @@ class VisionTestApp(ctk.CTk):
     def mark_roi_start(self, event):
         """Records the starting point of the ROI selection."""
         if not self.roi_enabled:
-            self.roi_start = (event.x, event.y)
+            self.roi_start = self._to_frame_coords(event)
 
     def mark_roi_drag(self, event):
         """Updates the end point of the ROI selection while dragging."""
         if not self.roi_enabled and self.roi_start:
-            self.roi_end = (event.x, event.y)
+            self.roi_end = self._to_frame_coords(event)
+            self._update_roi_box()
 
     def mark_roi_end(self, event):
         """Finalizes the ROI selection."""
         if not self.roi_enabled and self.roi_start:
-            self.roi_end = (event.x, event.y)
+            self.roi_end = self._to_frame_coords(event)
+            self._update_roi_box()
             self.roi_enabled = True # Lock ROI after selection
             self.update_status("ROI selected. Ready to calibrate.", "yellow")
 
-    def get_roi_box(self):
-        """Calculates and returns the ROI coordinates (x, y, width, height)."""
+    def _to_frame_coords(self, event):
+        """Converts mouse coordinates on the (possibly downscaled) video display to full frame coordinates."""
+        return (event.x * self.display_scale, event.y * self.display_scale)
+
+    def _update_roi_box(self):
+        """Recalculates the cached ROI coordinates (x, y, width, height) from roi_start/roi_end."""
         if self.roi_start and self.roi_end:
             x1, y1 = self.roi_start
             x2, y2 = self.roi_end
             # Ensure coordinates are in the correct order (top-left to bottom-right)
-            return (min(x1,x2), min(y1,y2), abs(x2 - x1), abs(y2 - y1))
-        return None
+            self._roi_box = (min(x1,x2), min(y1,y2), abs(x2 - x1), abs(y2 - y1))
+        else:
+            self._roi_box = None
+
+    def get_roi_box(self):
+        """Returns the cached ROI coordinates (x, y, width, height), or None if no ROI is set."""
+        return self._roi_box
 
     def calibrate_reference(self):
         """
@@ -176,24 +215,34 @@ class VisionTestApp(ctk.CTk):
         All GUI updates are scheduled using self.after() for thread safety.
         """
         x, y, w, h = self.get_roi_box()
-        self.after(0, lambda: self.update_status("Calibrating... please wait", "yellow"))
-        self.after(0, lambda: self.progress.set(0))
+        self.after(0, self.update_status, "Calibrating... please wait", "yellow")
+        self.after_idle(self.progress.set, 0)
         self.after(0, lambda: self.progress.pack(pady=10)) # Show calibration progress bar
-        self.after(0, lambda: self.update_test_result(""))
+        self.after(0, self.update_test_result, "")
 
-        # Loop to capture and save reference images
+        # Loop to capture reference images, kept in memory as CLAHE-processed grayscale ROIs
+        refs = []
+        used_seq = None # Sequence number of the frame used for the previous reference
         for i in range(self.num_ref_images):
-            # Ensure last_frame is not None before slicing
-            if self.last_frame is not None:
-                roi_img = self.last_frame[y:y+h, x:x+w]
-                filename = os.path.join(self.ref_folder, f"ref_{i}.png")
-                cv2.imwrite(filename, roi_img)
-                self.after(0, lambda: self.progress.set((i+1)/self.num_ref_images))
-                self.after(0, self.update) # Force GUI update
-                time.sleep(0.2) # Small delay between captures
+            # Wait for a frame that was not used yet, so each reference comes from a different frame
+            with self._frame_cv:
+                self._frame_cv.wait_for(lambda: self._frame_seq != used_seq, timeout=0.5)
+                frame = self.last_frame
+                used_seq = self._frame_seq
+            # Ensure a frame is available before slicing
+            if frame is not None:
+                roi_img = frame[y:y+h, x:x+w]
+                refs.append(self.image_processor.preprocess_with_clahe(roi_img))
+                self.after_idle(self.progress.set, (i+1)/self.num_ref_images)
+
+        # Cache the references directly, testing can start without touching the disk
+        self.image_processor.set_references(refs, self.num_ref_images)
 
         self.after(0, self.progress.pack_forget) # Hide calibration progress bar
-        self.after(0, lambda: self.update_status("Calibration complete ✅", "green"))
+        self.after(0, self.update_status, "Calibration complete ✅", "green")
+
+        # Persist the references for later runs; still on the calibration thread, off the test path
+        self.image_processor.save_references(self.ref_folder)
 
 
     def start_testing(self):
@@ -202,58 +251,108 @@ class VisionTestApp(ctk.CTk):
             self.update_status("No ROI selected ❌", "red")
             return
 
-        # Check if all reference images exist
-        for i in range(self.num_ref_images):
-            path = os.path.join(self.ref_folder, f"ref_{i}.png")
-            if not os.path.exists(path):
-                self.update_status("Missing reference images ❌", "red")
-                return
+        # Calibration fills the reference cache; otherwise try references left on disk by a previous run
+        if not self.image_processor.ref_ready:
+            self.image_processor.load_references(self.ref_folder, self.num_ref_images)
+        if not self.image_processor.ref_ready:
+            self.update_status("Missing reference images ❌", "red")
+            return
 
         self.testing = True # Set testing flag to true
         self.update_status("Testing...", "yellow")
         self.update_test_result("")
 
+    def _pump_frame(self):
+        """
+        Pulls the newest frame from CameraHandler and processes it, then reschedules itself.
+        Frames that arrived in between are dropped, so the display never falls behind the camera.
+        """
+        if not self.running:
+            return
+        frame = self.camera_handler.get_latest_frame()
+        if frame is not None:
+            self.process_and_display_frame(frame)
+        self.after(33, self._pump_frame)
+
     def process_and_display_frame(self, frame):
         """
-        Callback function called by CameraHandler when a new frame is ready.
+        Called by _pump_frame on the GUI thread when a new frame is available.
         Processes the frame, updates the display, and performs testing if active.
         """
-        self.last_frame = frame.copy() # Store the current frame
-
-        display_frame = frame.copy()
+        # Store the current frame; CameraHandler hands over a fresh array per frame, so no copy is needed
+        with self._frame_cv:
+            self.last_frame = frame
+            self._frame_seq += 1
+            self._frame_cv.notify_all() # Wake up calibration waiting for a new frame
+        roi_box = self._roi_box # Read once for both the overlay and the test hand-off
+
+        # Convert frame to RGB for CustomTkinter display into the reusable buffer, which we then draw on
+        display_frame = frame
+        if self.display_scale > 1:
+            # Downscale for display only, last_frame keeps the full resolution
+            display_frame = cv2.resize(frame, (self._small_buf.shape[1], self._small_buf.shape[0]),
+                                       dst=self._small_buf, interpolation=cv2.INTER_AREA)
+        img_rgb = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
         # Draw ROI rectangle if selected
-        if self.get_roi_box():
-            x, y, w, h = self.get_roi_box()
-            cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0,255,0), 2)
+        if roi_box:
+            x, y, w, h = (v // self.display_scale for v in roi_box)
+            cv2.rectangle(img_rgb, (x, y), (x+w, y+h), (0,255,0), 2)
+
+        # Wrap the buffer as a PIL image without copying and paste it into the persistent PhotoImage
+        h, w = img_rgb.shape[:2]
+        img_pil = Image.frombuffer("RGB", (w, h), img_rgb, "raw", "RGB", 0, 1)
+        # Already on the GUI thread, so the Tk image is updated (and the buffer consumed) right away
+        self._tk_img.paste(img_pil)
+
+
+        # Hand the test off to the worker so the GUI thread is not blocked
+        if self.testing and self._pending_test is None and roi_box:
+            self.testing = False # Reset testing flag, one test cycle per request
+            x, y, w, h = roi_box
+            roi_live = frame[y:y+h, x:x+w].copy()
+            self._pending_test = self._test_executor.submit(self._run_one_test, roi_live)
+            self._pending_test.add_done_callback(self._on_test_done)
+
+    def _on_test_done(self, future):
+        """
+        Clears the in-flight test so the next test cycle can be submitted.
+        Errors raised by the test cycle are reported instead of being dropped by the executor.
+        """
+        self._pending_test = None
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.after(0, self.update_status, f"Test Error: {error} ❌", "red")
+            self.after(0, self.update_test_result, "FAIL ❌ (test error)", "red")
 
-        # Convert frame to PhotoImage for CustomTkinter display
-        img_rgb = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-        img_pil = ImageTk.PhotoImage(Image.fromarray(img_rgb))
-        # Use .after() to ensure GUI updates happen on the main thread
-        self.after(0, lambda: self.video_label.configure(image=img_pil))
-        self.after(0, lambda: setattr(self.video_label, 'image', img_pil))
-
-
-        if self.testing:
-            # Get the live ROI
-            x, y, w, h = self.get_roi_box()
-            roi_live = frame[y:y+h, x:x+w]
-            # Preprocess the live ROI using the ImageProcessor
-            live_proc = self.image_processor.preprocess_with_clahe(roi_live)
-
-            max_diff_ratio = 0
-            change_detected = False
-
-            # Compare live ROI with all reference images
-            for i in range(self.num_ref_images):
-                ref_path = os.path.join(self.ref_folder, f"ref_{i}.png")
-                ref_img = cv2.imread(ref_path)
-                if ref_img is None:
-                    continue
-
-                # Preprocess and align reference image
-                ref_proc = self.image_processor.preprocess_with_clahe(ref_img)
-                aligned_live = self.image_processor.align_images(ref_proc, live_proc)
+    def _run_one_test(self, roi_live):
+        """
+        Compares a live ROI against the cached reference images, run on the test worker thread.
+        The result is posted back to the GUI thread using self.after().
+        """
+        # Preprocess the live ROI using the ImageProcessor
+        # The result is only used within this cycle on the single test worker, so the buffers can be reused
+        live_proc = self.image_processor.preprocess_with_clahe(roi_live, reuse_buffers=True)
+
+        max_diff_ratio = 0
+        change_detected = False
+
+        refs_stack = self.image_processor.refs_stack
+        if refs_stack is not None and refs_stack.shape[1:] == live_proc.shape:
+            # Same-sized references need no alignment, so compare against all of them in one pass
+            change_detected, max_diff_ratio = self.image_processor.pixel_diff_change_refs(live_proc, refs_stack)
+        else:
+            refs = self.image_processor.ref_cache_proc # One snapshot, calibration may swap the list
+            # Only this path runs template matching, so upload to the OpenCL device here, on demand
+            use_opencl = self.image_processor.opencl_available()
+            live_umat = cv2.UMat(live_proc) if use_opencl else None
+
+            # Compare live ROI with all cached (preprocessed) reference images
+            for ref_proc in refs:
+                ref_umat = cv2.UMat(ref_proc) if use_opencl else None
+                # Align live ROI to the reference image
+                aligned_live = self.image_processor.align_images(ref_proc, live_proc, ref_umat, live_umat)
                 # Calculate pixel difference
                 change, diff_ratio = self.image_processor.pixel_diff_change(ref_proc, aligned_live)
 
@@ -262,13 +361,11 @@ class VisionTestApp(ctk.CTk):
                     change_detected = True
                     break # Stop if a significant change is detected
 
-            # Update test result based on detection
-            if change_detected:
-                self.after(0, lambda: self.update_test_result(f"FAIL ❌ (Diff={max_diff_ratio:.2%})", "red"))
-            else:
-                self.after(0, lambda: self.update_test_result(f"PASS ✅ (Diff={max_diff_ratio:.2%})", "green"))
-
-            self.testing = False # Reset testing flag after one test cycle
+        # Update test result based on detection
+        if change_detected:
+            self.after(0, self.update_test_result, f"FAIL ❌ (Diff={max_diff_ratio:.2%})", "red")
+        else:
+            self.after(0, self.update_test_result, f"PASS ✅ (Diff={max_diff_ratio:.2%})", "green")
 
     def on_closing(self):
         """Handles the application closing event, stopping the camera thread gracefully."""
@@ -288,5 +385,7 @@ class VisionTestApp(ctk.CTk):
         except Exception as e:
             print(f"Error during thread join: {e}")
         finally:
+            # Drop any queued test cycle, the window is going away
+            self._test_executor.shutdown(wait=False)
             # Destroy the CustomTkinter window
             self.destroy()
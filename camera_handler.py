@@ -3,13 +3,16 @@ from pyueye import ueye
 import numpy as np
 import cv2
 import time
+import threading
+import ctypes
 
 class CameraHandler:
-    def __init__(self, on_status_update=None, on_frame_ready=None, on_init_progress=None, on_init_complete=None):
+    def __init__(self, on_status_update=None, on_init_progress=None, on_init_complete=None):
         """
         Initializes the CameraHandler.
+        Captured frames are not pushed to the application; they are kept in a single
+        "latest frame" slot which the application polls with get_latest_frame().
         :param on_status_update: Callback function to update application status (text, color).
-        :param on_frame_ready: Callback function to send captured frames to the application.
         :param on_init_progress: Callback function to update initialization progress.
         :param on_init_complete: Callback function to signal when camera initialization is complete.
         """
@@ -22,10 +25,14 @@ class CameraHandler:
 
         self.running = False # Flag to control the camera capture loop
         self.on_status_update = on_status_update
-        self.on_frame_ready = on_frame_ready
         self.on_init_progress = on_init_progress
         self.on_init_complete = on_init_complete # New callback
 
+        self._latest_frame = None # Most recent frame not yet taken by the application
+        self._frame_lock = threading.Lock() # Guards _latest_frame between capture and GUI threads
+        self._frame_view = None # Zero-copy NumPy view of the uEye image memory, built on first capture
+        self._frame_event = False # True when the capture loop can wait on the SDK's frame event
+
     def _update_status(self, text, color="white"):
         """Helper to call the status update callback if provided."""
         if self.on_status_update:
@@ -88,6 +95,14 @@ class CameraHandler:
                 self.release_camera()
                 return False
 
+            # Enable the frame event so the capture loop wakes up exactly when a new frame is ready.
+            # Falls back to polling if the installed SDK does not support it (pyueye raises
+            # NotImplementedError for functions the SDK library does not export)
+            try:
+                self._frame_event = ueye.is_EnableEvent(self.hCam, ueye.IS_SET_EVENT_FRAME) == ueye.IS_SUCCESS
+            except NotImplementedError:
+                self._frame_event = False
+
             # Start continuous video capture
             ret = ueye.is_CaptureVideo(self.hCam, ueye.IS_DONT_WAIT)
             if ret != ueye.IS_SUCCESS:
@@ -95,12 +110,8 @@ class CameraHandler:
                 self.release_camera()
                 return False
 
-            # Simulate initialization delay with progress bar
-            delay_sec = 5
-            steps = 50
-            for i in range(steps):
-                time.sleep(delay_sec / steps)
-                self._update_init_progress((i+1)/steps)
+            # Setup succeeded, the camera is ready right away
+            self._update_init_progress(1.0)
 
             self._update_status("Camera Ready. Please select ROI.", "white")
             self._on_init_complete() # Signal completion
@@ -118,6 +129,21 @@ class CameraHandler:
             return
 
         while self.running:
+            # Block until the camera signals a new frame (timeout in ms keeps the loop responsive to stop requests)
+            if self._frame_event:
+                try:
+                    ret = ueye.is_WaitEvent(self.hCam, ueye.IS_SET_EVENT_FRAME, 100)
+                except NotImplementedError: # is_WaitEvent is not available in the Windows SDK
+                    ret = None
+                if ret == ueye.IS_TIMED_OUT:
+                    continue # No new frame yet
+                if ret != ueye.IS_SUCCESS:
+                    # Waiting is unsupported or failed outright (e.g. camera disconnected); fall back to
+                    # polling with a delay so the loop does not spin on an error that returns immediately
+                    self._disable_frame_event()
+                    time.sleep(0.01)
+                    continue
+
             # Inquire image memory to get current frame data
             ret = ueye.is_InquireImageMem(self.hCam, self.pcImageMemory, self.MemID,
                                          ueye.int(self.width), ueye.int(self.height),
@@ -127,33 +153,69 @@ class CameraHandler:
                 time.sleep(0.01) # Small delay to prevent busy-waiting
                 continue
 
-            # Get data from image memory
-            array = ueye.get_data(self.pcImageMemory, self.width, self.height,
-                                  self.bitspixel, self.pitch, copy=True)
-            
-            if array is None or array.size == 0:
-                time.sleep(0.01)
-                continue
+            # Wrap the image memory once; the pitch is only known after the inquiry above
+            if self._frame_view is None:
+                self._frame_view = self._wrap_image_memory()
+                if self._frame_view is None:
+                    time.sleep(0.01)
+                    continue
 
-            # Reshape the array into a BGR image (height, width, channels)
-            frame = np.reshape(array, (self.height, self.width, 3))
+            # Single copy out of the image memory: the camera keeps overwriting it,
+            # while the frame is handed over to the GUI and test threads
+            frame = self._frame_view.copy()
 
-            # Send the frame to the application for processing and display
-            if self.on_frame_ready:
-                self.on_frame_ready(frame)
+            # Publish the frame, replacing any older frame the application has not taken yet
+            with self._frame_lock:
+                self._latest_frame = frame
 
-            time.sleep(0.03) # Control frame rate
+            if not self._frame_event:
+                time.sleep(0.01) # Small delay to prevent busy-waiting when polling
 
         self.release_camera() # Ensure camera is released when loop stops
 
+    def _wrap_image_memory(self):
+        """
+        Wraps the uEye image memory as a BGR NumPy array (height, width, channels) without copying it.
+        Rows are laid out using the memory pitch, so any padding at the end of a row is skipped.
+        :return: NumPy view of the image memory, or None if the memory is not allocated.
+        """
+        address = ctypes.cast(self.pcImageMemory, ctypes.c_void_p).value
+        pitch = self.pitch.value
+        if not address or pitch <= 0:
+            return None
+        buf = (ctypes.c_uint8 * (self.height * pitch)).from_address(address)
+        rows = np.frombuffer(buf, dtype=np.uint8).reshape(self.height, pitch)
+        return rows[:, :self.width * 3].reshape(self.height, self.width, 3)
+
+    def get_latest_frame(self):
+        """
+        Takes the most recent captured frame out of the slot.
+        :return: The newest frame (NumPy array), or None if no new frame arrived since the last call.
+        """
+        with self._frame_lock:
+            frame = self._latest_frame
+            self._latest_frame = None
+        return frame
+
     def stop_capture_loop(self):
         """Stops the camera capture loop."""
         self.running = False
 
+    def _disable_frame_event(self):
+        """Disables the frame event (if enabled) so the capture loop falls back to polling."""
+        if self._frame_event:
+            self._frame_event = False
+            try:
+                ueye.is_DisableEvent(self.hCam, ueye.IS_SET_EVENT_FRAME)
+            except NotImplementedError:
+                pass
+
     def release_camera(self):
         """Releases the camera resources."""
         if self.hCam:
             ueye.is_StopLiveVideo(self.hCam, ueye.IS_FORCE_VIDEO_STOP)
+            self._disable_frame_event()
+            self._frame_view = None # The view would point at freed memory
             ueye.is_FreeImageMem(self.hCam, self.pcImageMemory, self.MemID)
             ueye.is_ExitCamera(self.hCam)
             self._update_status("Camera Disconnected.", "gray")
@@ -1,37 +1,187 @@
 # image_processor.py
+import os
+import threading
 import cv2
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError: # Numba is optional, the NumPy path is used without it
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _count_diffs(refs, live, thr):
+        """
+        Counts, for each reference in 'refs' (N, h, w), the pixels differing from 'live' (h, w) by more than 'thr'.
+        Fuses absdiff, threshold and count into one pass without intermediate buffers, parallel over references.
+        """
+        n_refs, h, w = refs.shape
+        out = np.zeros(n_refs, np.int64)
+        for n in prange(n_refs):
+            c = 0
+            for i in range(h):
+                for j in range(w):
+                    # Signed casts: int() of a uint8 is unsigned in Numba and would wrap when live > ref
+                    d = np.int32(refs[n, i, j]) - np.int32(live[i, j])
+                    if d < 0:
+                        d = -d
+                    if d > thr:
+                        c += 1
+            out[n] = c
+        return out
+else:
+    _count_diffs = None
+
+def _count_diffs_numpy(refs_i16, live, thr):
+    """
+    NumPy equivalent of _count_diffs, taking the references already converted to int16 (N, h, w).
+    """
+    # Absolute difference against every reference at once (int16 avoids uint8 wrap-around)
+    diffs = np.abs(refs_i16 - live.astype(np.int16)[None])
+    # Count changed pixels per reference
+    return np.count_nonzero((diffs > thr).reshape(len(refs_i16), -1), axis=1)
+
 class ImageProcessor:
     """
     A utility class for image processing operations.
-    All methods are static as they operate on input images without needing instance state.
+    Holds a cache of preprocessed reference images so they are not re-read and
+    re-processed on every test cycle.
     """
 
+    def __init__(self):
+        """Initializes the per-thread CLAHE storage and the reference cache."""
+        # One persistent CLAHE instance per thread: cv2.CLAHE keeps scratch buffers and releases
+        # the GIL in apply(), so sharing one instance between threads would race
+        self._clahe_local = threading.local()
+        self.ref_cache_proc = [] # CLAHE-processed grayscale reference images
+        self.ref_ready = False # True once all requested references were loaded into the cache
+        self.refs_stack = None # Same references stacked as one (N, h, w) array for vectorized comparison
+        self._refs_stack_i16 = None # int16 copy of refs_stack for the NumPy fallback, converted once
+        # Whether OpenCV's OpenCL T-API (cv2.UMat) is used for template matching;
+        # None until probed by opencl_available(), which is kept off the GUI thread
+        self.use_opencl = None
+        self._gray_buf = None # Reusable grayscale/CLAHE output buffers for preprocess_with_clahe(reuse_buffers=True)
+        self._clahe_buf = None
+
+    def load_references(self, folder, count):
+        """
+        Loads the reference images from disk and caches them for testing.
+        References are stored already CLAHE-processed in grayscale during calibration,
+        so they are read directly as grayscale and used as-is. Files from older versions
+        (ref_<i>.png, raw BGR ROIs) are not picked up and count as missing.
+        :param folder: Folder containing the ref_clahe_<i>.png files.
+        :param count: Number of reference images to load.
+        :return: Number of reference images successfully cached.
+        """
+        refs = []
+        for i in range(count):
+            path = os.path.join(folder, f"ref_clahe_{i}.png")
+            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                continue
+            refs.append(img)
+        self.set_references(refs, count)
+        return len(refs)
+
+    def set_references(self, refs, count):
+        """
+        Caches already CLAHE-processed grayscale reference images for testing.
+        :param refs: List of preprocessed reference images (NumPy arrays).
+        :param count: Number of reference images expected; ref_ready is only set if all are present.
+        """
+        self.ref_cache_proc = refs # Swap in the complete list at once
+        self.ref_ready = len(refs) == count
+        # Stacking needs all references to share one shape (they do when captured with the same ROI)
+        if refs and all(r.shape == refs[0].shape for r in refs):
+            refs_stack = np.stack(refs)
+            # Without Numba, the diff needs signed values; convert once here instead of on every test
+            self._refs_stack_i16 = refs_stack.astype(np.int16) if _count_diffs is None else None
+            self.refs_stack = refs_stack
+        else:
+            self._refs_stack_i16 = None
+            self.refs_stack = None
+
+    def save_references(self, folder):
+        """
+        Writes the cached reference images to disk as ref_clahe_<i>.png, so a later run can load them.
+        :param folder: Folder to write the reference images to.
+        """
+        for i, ref in enumerate(self.ref_cache_proc):
+            cv2.imwrite(os.path.join(folder, f"ref_clahe_{i}.png"), ref)
+
+    def opencl_available(self):
+        """
+        Probes the OpenCL runtime on first call (this can take a while) and enables the T-API if a device exists.
+        :return: True if template matching can run on an OpenCL device.
+        """
+        if self.use_opencl is None:
+            self.use_opencl = cv2.ocl.haveOpenCL()
+            cv2.ocl.setUseOpenCL(self.use_opencl)
+        return self.use_opencl
+
     @staticmethod
-    def preprocess_with_clahe(img):
+    def warm_up():
+        """
+        Compiles the Numba diff kernel (if Numba is available) so the first test cycle does not pay for it,
+        and checks it against the NumPy implementation; on a mismatch the NumPy path is used instead.
+        """
+        global _count_diffs
+        if _count_diffs is None:
+            return
+        # Random images contain pixels where live is above, below and equal to the reference
+        rng = np.random.default_rng(0)
+        refs = rng.integers(0, 256, size=(3, 32, 32), dtype=np.uint8)
+        live = rng.integers(0, 256, size=(32, 32), dtype=np.uint8)
+        expected = _count_diffs_numpy(refs.astype(np.int16), live, 25)
+        if not np.array_equal(_count_diffs(refs, live, 25), expected):
+            print("Numba diff kernel does not match the NumPy result, falling back to NumPy")
+            _count_diffs = None
+
+    def _get_clahe(self):
+        """Returns the calling thread's CLAHE instance, creating it on first use."""
+        clahe = getattr(self._clahe_local, "clahe", None)
+        if clahe is None:
+            clahe = self._clahe_local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        return clahe
+
+    def preprocess_with_clahe(self, img, reuse_buffers=False):
         """
         Applies CLAHE (Contrast Limited Adaptive Histogram Equalization) to an image.
         Converts the image to grayscale first.
         :param img: Input BGR image (NumPy array).
+        :param reuse_buffers: If True, write into preallocated buffers instead of allocating new arrays.
+                              The returned image is then overwritten by the next such call, so only
+                              use it for results that are not kept (e.g. the live ROI of one test cycle)
+                              and from a single thread.
         :return: Processed grayscale image.
         """
+        gray_dst = clahe_dst = None # None lets OpenCV allocate new output arrays
+        if reuse_buffers:
+            # (Re)allocate the buffers only when the ROI size changes
+            h, w = img.shape[:2]
+            if self._clahe_buf is None or self._clahe_buf.shape != (h, w):
+                self._gray_buf = np.empty((h, w), dtype=np.uint8)
+                self._clahe_buf = np.empty((h, w), dtype=np.uint8)
+            gray_dst, clahe_dst = self._gray_buf, self._clahe_buf
+
         if len(img.shape) == 3: # Check if it's a color image
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray_dst)
         else: # Assume it's already grayscale
             gray = img
-        
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        return clahe.apply(gray)
+
+        return self._get_clahe().apply(gray, dst=clahe_dst) # Reuse this thread's persistent CLAHE instance
 
     @staticmethod
-    def align_images(template, image):
+    def align_images(template, image, template_umat=None, image_umat=None):
         """
         Aligns an 'image' to a 'template' using template matching.
         This is a simple alignment and assumes the template is present within the image.
         It returns the region of 'image' that best matches the 'template'.
         :param template: The reference image (grayscale, preprocessed).
         :param image: The live image (grayscale, preprocessed) to align.
+        :param template_umat: Optional cv2.UMat of 'template', to run the matching on the OpenCL device.
+        :param image_umat: Optional cv2.UMat of 'image', used together with 'template_umat'.
         :return: The aligned region of the 'image' with the same dimensions as the 'template'.
                  If alignment fails or dimensions mismatch, it returns a cropped version of the image.
         """
@@ -41,8 +191,15 @@ class ImageProcessor:
         if len(image.shape) == 3:
             image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-        # Perform template matching
-        res = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+        # Same-sized images leave only one possible match position, so matching is a no-op
+        if template.shape == image.shape:
+            return image
+
+        # Perform template matching, on the OpenCL device if the images were uploaded
+        if template_umat is not None and image_umat is not None:
+            res = cv2.matchTemplate(image_umat, template_umat, cv2.TM_CCOEFF_NORMED)
+        else:
+            res = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
         # Find the location of the best match
         _, _, _, max_loc = cv2.minMaxLoc(res)
         x, y = max_loc # Top-left corner of the matched region
@@ -59,6 +216,37 @@ class ImageProcessor:
             return image[:h, :w]
         return aligned
 
+    def pixel_diff_change_refs(self, live, refs_stack=None, threshold=25, change_ratio_threshold=0.02):
+        """
+        Compares a live grayscale image against all cached references in a single vectorized pass.
+        The live image must have the same dimensions as the references (see refs_stack).
+        :param live: Live grayscale image, already preprocessed.
+        :param refs_stack: Snapshot of refs_stack to compare against; defaults to the current refs_stack.
+                           Pass the snapshot whose shape was checked, calibration may swap refs_stack meanwhile.
+        :param threshold: Pixel intensity difference threshold to consider a pixel "changed".
+        :param change_ratio_threshold: Percentage of changed pixels to consider a significant change.
+        :return: Tuple (bool: True if change detected against any reference, float: highest ratio of changed pixels).
+        """
+        refs = self.refs_stack if refs_stack is None else refs_stack
+        if refs is None or live.size == 0:
+            return False, 0.0
+        # The Numba kernel does no bounds checking, so never let mismatched shapes reach it
+        if refs.shape[1:] != live.shape:
+            raise ValueError(f"Live image shape {live.shape} does not match reference shape {refs.shape[1:]}")
+
+        if _count_diffs is not None:
+            # Fused, parallel count of changed pixels per reference
+            counts = _count_diffs(refs, np.ascontiguousarray(live), threshold)
+        else:
+            refs_i16 = self._refs_stack_i16
+            if refs_i16 is None or refs_i16.shape != refs.shape:
+                refs_i16 = refs.astype(np.int16) # References were swapped meanwhile, convert this once
+            counts = _count_diffs_numpy(refs_i16, live, threshold)
+        ratios = counts / live.size
+
+        max_ratio = float(ratios.max())
+        return bool((ratios > change_ratio_threshold).any()), max_ratio
+
     @staticmethod
     def pixel_diff_change(ref, live, threshold=25, change_ratio_threshold=0.02):
         """
@@ -81,12 +269,10 @@ class ImageProcessor:
 
         # Calculate absolute difference between images
         diff = cv2.absdiff(ref, live)
-        # Apply a binary threshold to highlight significant differences
-        _, binary = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
-        # Count non-zero pixels (pixels that changed above the threshold)
-        diff_pixels = cv2.countNonZero(binary)
+        # Count pixels that changed above the threshold, without materializing a 0/255 binary mask
+        diff_pixels = int(np.count_nonzero(diff > threshold))
         # Calculate total pixels in the comparison area
-        total_pixels = binary.size
+        total_pixels = diff.size
         
         if total_pixels == 0: # Avoid division by zero
             return False, 0.0
@@ -1,19 +1,33 @@
+import threading
 import cv2
 import numpy as np
 
 class VisionProcessor:
     """A collection of static methods for image processing tasks."""
 
+    # One CLAHE instance per thread, created once instead of on every call
+    # (a single shared instance is not safe to use from several threads)
+    _clahe_local = threading.local()
+
+    @staticmethod
+    def _get_clahe() -> cv2.CLAHE:
+        """Returns the calling thread's CLAHE instance, creating it on first use."""
+        clahe = getattr(VisionProcessor._clahe_local, "clahe", None)
+        if clahe is None:
+            clahe = VisionProcessor._clahe_local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        return clahe
+
     @staticmethod
     def preprocess_with_clahe(img: np.ndarray) -> np.ndarray:
         """Applies CLAHE for contrast enhancement."""
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        return clahe.apply(gray)
+        return VisionProcessor._get_clahe().apply(gray)
 
     @staticmethod
     def align_images(template: np.ndarray, image: np.ndarray) -> np.ndarray:
         """Aligns the live image to the template using template matching."""
+        if template.shape == image.shape:
+            return image  # Only one possible match position, nothing to align
         res = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
         _, _, _, max_loc = cv2.minMaxLoc(res)
         x, y = max_loc
@@ -27,9 +41,8 @@ class VisionProcessor:
     def pixel_diff_change(ref: np.ndarray, live: np.ndarray, threshold: int = 25) -> tuple[bool, float]:
         """Compares two images and returns True if the difference exceeds a threshold."""
         diff = cv2.absdiff(ref, live)
-        _, binary = cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)
-        diff_pixels = cv2.countNonZero(binary)
-        total_pixels = binary.size
+        diff_pixels = int(np.count_nonzero(diff > threshold))
+        total_pixels = diff.size
         if total_pixels == 0:
             return False, 0.0
         ratio = diff_pixels / total_pixels